@@ -1,11 +1,14 @@
 import unittest
-from worklog import Entry
+from worklog import Entry, ChangeLog, Employee, Task, JournalKey
 import unittest.mock as mock
 from peewee import *
 import worklog
 import datetime
+import json
+import os
+import tempfile
 
-MODELS = [Entry]
+MODELS = [Employee, Task, Entry, ChangeLog, JournalKey]
 
 test_entry = {
     "task": "Beau test",
@@ -109,9 +112,23 @@ class BaseTestCase(unittest.TestCase):
 
     def test_initialize(self):
         expected = True
-        actual = worklog.initialize()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.journal')
+            with mock.patch('worklog.JOURNAL_FILE', path):
+                actual = worklog.initialize()
+                self.addCleanup(worklog.db.close)
         self.assertEqual(actual, expected)
 
+    def test_initialize_replays_journal(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.journal')
+            worklog.journal_entry(path=path, **test_entry)
+            with mock.patch('worklog.JOURNAL_FILE', path):
+                worklog.initialize()
+                self.addCleanup(worklog.db.close)
+            self.assertFalse(os.path.exists(path))
+        self.assertEqual(Entry.select().count(), 3)
+
     def test_clear(self):
         """testing clear function calls os.system"""
         with unittest.mock.patch('worklog.os') as Mocked_os:
@@ -198,6 +215,213 @@ class BaseTestCase(unittest.TestCase):
             worklog.delete_task(index, entries)
             self.assertEqual(Entry.select().count(), 1)
 
+    # Storage
+
+    def test_migrate_storage(self):
+        test_db.drop_tables([Entry, Employee, Task])
+        test_db.execute_sql(
+            "CREATE TABLE entry (id INTEGER PRIMARY KEY, "
+            "task VARCHAR(255), date DATETIME, employee VARCHAR(255), "
+            "duration INTEGER, notes VARCHAR(255))")
+        test_db.execute_sql(
+            "INSERT INTO entry VALUES "
+            "(3, 'Beau test', '1992-08-24 00:00:00', 'Ben', 20, ''), "
+            "(7, 'Task two', '2001-06-23 00:00:00', 'Ben', 110, 'Notes')")
+        self.assertTrue(worklog.migrate_storage())
+        self.assertFalse(worklog.migrate_storage())
+        entries = worklog.fetch_tasks()
+        self.assertEqual([entry.id for entry in entries], [7, 3])
+        self.assertEqual(entries[1].date, test_entry["date"])
+        self.assertEqual(entries[0].task, "Task two")
+        self.assertEqual(Employee.select().count(), 1)
+
+    def test_entry_stores_day_number(self):
+        day = Entry.select(Entry.date.cast('integer')).where(
+            Entry.duration == test_entry["duration"]).scalar()
+        self.assertEqual(day, 8271)
+
+    def test_query_by_date(self):
+        self.assertEqual(Entry.select().where(
+            Entry.date == test_entry["date"]).count(), 1)
+        self.assertEqual(Entry.select().where(
+            Entry.date >= datetime.datetime(1992, 8, 25)).count(), 1)
+
+    def test_with_names(self):
+        entry = Entry.with_names().where(Employee.name ==
+                                         test_entry["employee"]).get()
+        self.assertEqual(entry.task, test_entry["task"])
+        self.assertEqual(entry.employee, test_entry["employee"])
+        self.assertEqual(entry.date, test_entry["date"])
+
+    def test_joined_name_follows_reference(self):
+        entry = Entry.with_names().where(Task.name ==
+                                         test_entry["task"]).get()
+        entry.task_ref = Task.get(Task.name == test_entry_2["task"])
+        self.assertEqual(entry.task, test_entry_2["task"])
+        entry.employee_ref = Employee.get(
+            Employee.name == test_entry_2["employee"]).id
+        self.assertEqual(entry.employee, test_entry_2["employee"])
+
+    # Change log
+
+    def test_create_entry_logs_change(self):
+        entry = worklog.create_entry(**test_entry)
+        change = ChangeLog.get(ChangeLog.entry_id == entry.id)
+        self.assertEqual(change.action, 'create')
+        self.assertEqual(json.loads(change.payload)["task"],
+                         test_entry["task"])
+
+    def test_save_entry_logs_change(self):
+        entry = Entry.select().first()
+        entry.duration = 45
+        worklog.save_entry(entry)
+        change = ChangeLog.get(ChangeLog.entry_id == entry.id)
+        self.assertEqual(change.action, 'update')
+        self.assertEqual(json.loads(change.payload)["duration"], 45)
+
+    def test_delete_entry_logs_change(self):
+        entries = Entry.select()
+        entry_id = entries[0].id
+        with mock.patch('builtins.input', side_effect=["y", ""]):
+            worklog.delete_task(0, entries)
+        change = ChangeLog.get(ChangeLog.entry_id == entry_id)
+        self.assertEqual(change.action, 'delete')
+
+    def test_backfill_change_log(self):
+        self.assertEqual(worklog.backfill_change_log(), 2)
+        changes = list(worklog.changes_since())
+        self.assertEqual([change.action for change in changes],
+                         ['create', 'create'])
+        self.assertEqual(worklog.backfill_change_log(), 0)
+
+    def test_changes_since_rejects_empty_batches(self):
+        with self.assertRaises(ValueError):
+            list(worklog.changes_since(batch_size=0))
+
+    def test_changes_since(self):
+        first = worklog.create_entry(**test_entry)
+        worklog.create_entry(**test_entry_2)
+        worklog.remove_entry(first)
+        changes = list(worklog.changes_since(batch_size=2))
+        self.assertEqual([change.action for change in changes],
+                         ['create', 'create', 'delete'])
+        cursor = changes[1].seq
+        newer = list(worklog.changes_since(cursor))
+        self.assertEqual([(change.entry_id, change.action)
+                          for change in newer], [(first.id, 'delete')])
+
+    # Journal
+
+    def test_flush_journal(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.journal')
+            worklog.journal_entry(path=path, **test_entry)
+            worklog.journal_entry(path=path, **test_entry_2)
+            self.assertEqual(Entry.select().count(), 2)
+            self.assertEqual(worklog.flush_journal(path, batch_size=1), 2)
+            self.assertEqual(Entry.select().count(), 4)
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(worklog.flush_journal(path), 0)
+
+    def test_flush_journal_replays_after_crash(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.journal')
+            worklog.journal_entry(path=path, **test_entry)
+            worklog.journal_entry(path=path, **test_entry_2)
+            lines = worklog.read_journal(path)
+            # First line was flushed before the crash; the last line
+            # was only partly written
+            JournalKey.create(key=json.loads(lines[0])['key'])
+            os.replace(path, path + '.flushing')
+            with open(path + '.flushing', 'a') as journal:
+                journal.write('{"key": "torn')
+            worklog.journal_entry(path=path, **test_entry)
+            self.assertEqual(worklog.flush_journal(path), 2)
+            self.assertEqual(Entry.select().count(), 4)
+            self.assertEqual(JournalKey.select().count(), 0)
+
+    def test_flush_journal_rejects_malformed_lines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.journal')
+            bad_lines = ['{"key": "a", "task": "x"}', 'not json',
+                         json.dumps(dict(test_entry_date, key="b",
+                                         date="31-02-2001"))]
+            with open(path, 'w') as journal:
+                journal.write('\n'.join(bad_lines) + '\n')
+            worklog.journal_entry(path=path, **test_entry)
+            with self.assertLogs('worklog', level='WARNING'):
+                self.assertEqual(worklog.flush_journal(path), 1)
+            self.assertEqual(Entry.select().count(), 3)
+            self.assertFalse(os.path.exists(path + '.flushing'))
+            self.assertEqual(worklog.read_journal(path + '.rejected'),
+                             bad_lines)
+
+    def test_flush_journal_rejects_unstorable_records(self):
+        create_entry = worklog.create_entry
+
+        def fail_first(**fields):
+            if fields["task"] == test_entry_2["task"]:
+                raise IntegrityError("cannot insert")
+            return create_entry(**fields)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.journal')
+            worklog.journal_entry(path=path, **dict(test_entry,
+                                                    duration=10 ** 20))
+            worklog.journal_entry(path=path, **test_entry_2)
+            worklog.journal_entry(path=path, **test_entry)
+            rejected = worklog.read_journal(path)[:2]
+            with mock.patch('worklog.create_entry', side_effect=fail_first):
+                with self.assertLogs('worklog', level='WARNING'):
+                    self.assertEqual(worklog.flush_journal(path), 1)
+            self.assertEqual(Entry.select().count(), 3)
+            self.assertFalse(os.path.exists(path + '.flushing'))
+            self.assertEqual(worklog.read_journal(path + '.rejected'),
+                             rejected)
+
+    def test_flush_journal_rejects_lines_once(self):
+        create_entry = worklog.create_entry
+        calls = []
+
+        def busy_once(**fields):
+            calls.append(fields)
+            if len(calls) == 1:
+                raise OperationalError("database is locked")
+            return create_entry(**fields)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.journal')
+            with open(path, 'w') as journal:
+                journal.write('not json\n')
+            worklog.journal_entry(path=path, **test_entry)
+            with mock.patch('worklog.create_entry', side_effect=busy_once):
+                with self.assertLogs('worklog', level='WARNING'):
+                    self.assertEqual(worklog.try_flush_journal(path), 0)
+                self.assertFalse(os.path.exists(path + '.rejected'))
+                with self.assertLogs('worklog', level='WARNING'):
+                    self.assertEqual(worklog.flush_journal(path), 1)
+            self.assertEqual(worklog.read_journal(path + '.rejected'),
+                             ['not json'])
+
+    def test_journal_date_round_trip(self):
+        date = datetime.datetime(999, 1, 1)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.journal')
+            worklog.journal_entry(path=path, **dict(test_entry, date=date))
+            self.assertEqual(worklog.flush_journal(path), 1)
+        self.assertEqual(Entry.select().where(Entry.date == date).count(), 1)
+
+    def test_initialize_with_busy_database(self):
+        with mock.patch('worklog.flush_journal',
+                        side_effect=OperationalError("database is locked")):
+            self.assertTrue(worklog.initialize())
+            self.addCleanup(worklog.db.close)
+
+    def test_validate_task_duration_too_long(self):
+        with unittest.mock.patch('builtins.input', side_effect=["20"]):
+            self.assertEqual(worklog.validate_task_duration(str(10 ** 20)),
+                             test_entry["duration"])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,25 +1,131 @@
 from collections import OrderedDict
 import datetime
+import json
+import logging
 import os
 import sys
+import threading
+import uuid
 
 from peewee import *
 
 db = SqliteDatabase('work_log.db')
 
+logger = logging.getLogger(__name__)
+
 DATE_FORMAT = "%d-%m-%Y"
 
+EPOCH = datetime.datetime(1970, 1, 1)
+
+JOURNAL_FILE = 'work_log.journal'
+FLUSH_INTERVAL = 1.0
+FLUSH_BATCH_SIZE = 100
+
+# Largest integer SQLite can store
+MAX_INTEGER = 2 ** 63 - 1
+
+# Guards appends to the journal against it being moved aside for flushing
+journal_lock = threading.Lock()
+flush_lock = threading.Lock()
+
+
+class Employee(Model):
+    """ Lookup table of employee names """
+    name = CharField(max_length=255, unique=True)
+
+    class Meta:
+        database = db
+
+
+class Task(Model):
+    """ Lookup table of task names """
+    name = CharField(max_length=255, unique=True)
+
+    class Meta:
+        database = db
+
+
+class DayField(IntegerField):
+    """ Stores a date as the number of days since the Unix epoch """
+    def db_value(self, value):
+        if isinstance(value, datetime.date):
+            value = value.toordinal() - EPOCH.toordinal()
+        return super().db_value(value)
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        return datetime.datetime.fromordinal(value + EPOCH.toordinal())
+
 
 class Entry(Model):
-    task = CharField(max_length=255)
-    date = DateTimeField()
-    employee = CharField(max_length=255)
+    task_ref = ForeignKeyField(Task, column_name='task_id')
+    # Only the day of a task is recorded
+    date = DayField(column_name='day', index=True)
+    employee_ref = ForeignKeyField(Employee, column_name='employee_id')
     duration = IntegerField()
     notes = CharField(max_length=255)
 
     class Meta:
         database = db
 
+    @classmethod
+    def with_names(cls):
+        """ Select entries joined with their task and employee names """
+        # Names are read onto the entry itself rather than building a
+        # Task and Employee instance for every row. The lookup ids are
+        # kept so a name is not used after its reference changes.
+        return (cls.select(cls,
+                           Task.id.alias('joined_task_id'),
+                           Task.name.alias('task_name'),
+                           Employee.id.alias('joined_employee_id'),
+                           Employee.name.alias('employee_name'))
+                .join(Task, on=cls.task_ref).switch(cls)
+                .join(Employee, on=cls.employee_ref).switch(cls)
+                .objects())
+
+    @property
+    def task(self):
+        joined_id = getattr(self, 'joined_task_id', None)
+        if joined_id is not None and joined_id == self.task_id:
+            return self.task_name
+        return self.task_ref.name
+
+    @task.setter
+    def task(self, name):
+        self.task_ref = Task.get_or_create(name=name)[0]
+
+    @property
+    def employee(self):
+        joined_id = getattr(self, 'joined_employee_id', None)
+        if joined_id is not None and joined_id == self.employee_id:
+            return self.employee_name
+        return self.employee_ref.name
+
+    @employee.setter
+    def employee(self, name):
+        self.employee_ref = Employee.get_or_create(name=name)[0]
+
+
+class ChangeLog(Model):
+    """ Append-only record of every change made to an Entry """
+    seq = AutoField()
+    entry_id = IntegerField()
+    action = CharField(max_length=10)
+    timestamp = DateTimeField(default=datetime.datetime.now)
+    payload = TextField()
+
+    class Meta:
+        database = db
+
+
+class JournalKey(Model):
+    """ Keys of journal lines already written to Entry """
+    key = CharField(max_length=32, unique=True)
+
+    class Meta:
+        database = db
+
 
 def clear():
     """Clear the screen in the command prompt."""
@@ -37,10 +143,59 @@ def quit():
 def initialize():
     """ Create database and table if they don't exist"""
     db.connect()
-    db.create_tables([Entry], safe=True)
+    migrate_storage()
+    db.create_tables([Employee, Task, Entry, ChangeLog, JournalKey],
+                     safe=True)
+    backfill_change_log()
+    # Replay anything saved but not flushed before the last exit
+    try_flush_journal()
     return True
 
 
+def migrate_storage():
+    """ Convert an entry table using the old text columns to the
+    compact format with day numbers and employee and task lookups """
+    database = Entry._meta.database
+    if not database.table_exists('entry'):
+        return False
+    columns = [column.name for column in database.get_columns('entry')]
+    if 'employee' not in columns:
+        return False
+    with database.atomic():
+        database.execute_sql("ALTER TABLE entry RENAME TO entry_legacy")
+        database.create_tables([Employee, Task, Entry])
+        database.execute_sql("INSERT OR IGNORE INTO employee (name) "
+                             "SELECT DISTINCT employee FROM entry_legacy")
+        database.execute_sql("INSERT OR IGNORE INTO task (name) "
+                             "SELECT DISTINCT task FROM entry_legacy")
+        # julianday() of the Unix epoch is 2440587.5
+        database.execute_sql(
+            "INSERT INTO entry "
+            "(id, task_id, day, employee_id, duration, notes) "
+            "SELECT l.id, t.id, "
+            "CAST(julianday(date(l.date)) - 2440587.5 AS INTEGER), "
+            "e.id, l.duration, l.notes FROM entry_legacy AS l "
+            "JOIN task AS t ON t.name = l.task "
+            "JOIN employee AS e ON e.name = l.employee")
+        database.execute_sql("DROP TABLE entry_legacy")
+    # Reclaim the space the text columns used
+    database.execute_sql("VACUUM")
+    return True
+
+
+def backfill_change_log():
+    """ Log a create for every entry saved before the change log existed,
+    so consumers reading from the start get a complete copy """
+    database = Entry._meta.database
+    with database.atomic():
+        if ChangeLog.select().exists():
+            return 0
+        entries = Entry.select().order_by(Entry.id)
+        for entry in entries:
+            record_change(entry, 'create')
+    return len(entries)
+
+
 def menu_loop():
     """Show the menu"""
     clear()
@@ -58,6 +213,7 @@ def menu_loop():
 
 def search_menu():
     """ Search menu """
+    try_flush_journal()
     entries = fetch_tasks()
     clear()
     if len(entries) == 0:
@@ -106,13 +262,219 @@ def add_entry():
 
 
 def add_to_database(task, date, employee, duration, notes):
-    Entry.create(task=task, date=date, employee=employee,
-                 duration=duration, notes=notes)
+    journal_entry(task, date, employee, duration, notes)
     clear()
     input("Entry Saved! Press any button to continue.")
     menu_loop()
 
 
+def entry_payload(entry):
+    """ Serialise an entry's fields for the change log """
+    return json.dumps({
+        "task": entry.task,
+        "date": entry.date.strftime(DATE_FORMAT),
+        "employee": entry.employee,
+        "duration": entry.duration,
+        "notes": entry.notes,
+    })
+
+
+def record_change(entry, action):
+    """ Append a change for an entry to the change log """
+    return ChangeLog.create(entry_id=entry.id, action=action,
+                            payload=entry_payload(entry))
+
+
+def create_entry(**fields):
+    """ Create an entry and log it in the same transaction """
+    with Entry._meta.database.atomic():
+        entry = Entry.create(**fields)
+        record_change(entry, 'create')
+    return entry
+
+
+def save_entry(entry):
+    """ Save changes to an entry and log them in the same transaction """
+    with Entry._meta.database.atomic():
+        entry.save()
+        record_change(entry, 'update')
+    return entry
+
+
+def remove_entry(entry):
+    """ Delete an entry and log it in the same transaction """
+    with Entry._meta.database.atomic():
+        record_change(entry, 'delete')
+        entry.delete_instance()
+    return True
+
+
+def changes_since(cursor=0, batch_size=100):
+    """ Stream changes logged after the given sequence number.
+
+    Consumers keep the seq of the last change they applied and pass it
+    back in as the cursor to pick up only newer changes.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be positive")
+    while True:
+        batch = list(ChangeLog.select()
+                     .where(ChangeLog.seq > cursor)
+                     .order_by(ChangeLog.seq)
+                     .limit(batch_size))
+        for change in batch:
+            yield change
+            cursor = change.seq
+        if len(batch) < batch_size:
+            return
+
+
+def journal_entry(task, date, employee, duration, notes, path=None):
+    """ Append an entry to the journal and sync it to disk """
+    path = path or JOURNAL_FILE
+    line = json.dumps({
+        "key": uuid.uuid4().hex,
+        "task": task,
+        "date": date.isoformat(),
+        "employee": employee,
+        "duration": duration,
+        "notes": notes,
+    })
+    with journal_lock:
+        append_line(path, line)
+
+
+def append_line(path, line):
+    """ Append a line to a file and sync it to disk """
+    with open(path, 'a') as journal:
+        journal.write(line + '\n')
+        journal.flush()
+        os.fsync(journal.fileno())
+
+
+def read_journal(path):
+    """ Read the complete lines of a journal file """
+    lines = []
+    with open(path) as journal:
+        for line in journal:
+            # A line without a newline was cut short by a crash
+            if not line.endswith('\n'):
+                break
+            lines.append(line.rstrip('\n'))
+    return lines
+
+
+def parse_record(line):
+    """ Parse a journal line into its key and entry fields.
+
+    Raises ValueError if the line is not a valid journal record.
+    """
+    try:
+        record = json.loads(line)
+        key = record['key']
+        fields = {
+            "task": record['task'],
+            "date": datetime.datetime.fromisoformat(record['date']),
+            "employee": record['employee'],
+            "duration": int(record['duration']),
+            "notes": record['notes'],
+        }
+    except (KeyError, TypeError) as error:
+        raise ValueError("Missing or invalid field: {}".format(error))
+    for value in (key, fields['task'], fields['employee'], fields['notes']):
+        if not isinstance(value, str):
+            raise ValueError("Expected text, got {!r}".format(value))
+    if abs(fields['duration']) > MAX_INTEGER:
+        raise ValueError("Duration out of range: {}".format(
+            fields['duration']))
+    return key, fields
+
+
+def flush_record(key, fields):
+    """ Write a journal record to Entry unless it already has been """
+    if JournalKey.select().where(JournalKey.key == key).exists():
+        return False
+    create_entry(**fields)
+    JournalKey.create(key=key)
+    return True
+
+
+def flush_journal(path=None, batch_size=FLUSH_BATCH_SIZE):
+    """ Move journalled entries into the database in batches.
+
+    The journal is moved aside before flushing so new entries can still
+    be appended. Flushed keys are recorded in the same transaction as the
+    entries, so a journal left behind by a crash is replayed safely.
+    Lines which are malformed or cannot be written are moved to a
+    .rejected file next to the journal.
+    """
+    path = path or JOURNAL_FILE
+    pending = path + '.flushing'
+    database = Entry._meta.database
+    flushed = 0
+    with flush_lock:
+        while True:
+            if not os.path.exists(pending):
+                with journal_lock:
+                    if not os.path.exists(path):
+                        return flushed
+                    os.replace(path, pending)
+            records = []
+            rejected = []
+            for line in read_journal(pending):
+                try:
+                    records.append((line, parse_record(line)))
+                except ValueError as error:
+                    logger.warning("Rejected journal line %r: %s",
+                                   line, error)
+                    rejected.append(line)
+            for start in range(0, len(records), batch_size):
+                with database.atomic():
+                    for line, record in records[start:start + batch_size]:
+                        try:
+                            with database.atomic():
+                                flushed += flush_record(*record)
+                        except OperationalError:
+                            # Database is busy; retry the whole batch later
+                            raise
+                        except Exception as error:
+                            logger.warning("Rejected journal line %r: %s",
+                                           line, error)
+                            rejected.append(line)
+            # Written once the batches commit so a retry does not repeat them
+            for line in rejected:
+                append_line(path + '.rejected', line)
+            os.remove(pending)
+            JournalKey.delete().execute()
+
+
+def try_flush_journal(path=None):
+    """ Flush the journal, leaving it for later if the database is busy """
+    try:
+        return flush_journal(path)
+    except OperationalError:
+        return 0
+
+
+def start_flusher(interval=FLUSH_INTERVAL, path=None):
+    """ Flush the journal from a background thread.
+
+    Returns an event which stops the thread when set.
+    """
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                try_flush_journal(path)
+            except Exception:
+                # Keep flushing later entries; this batch stays journalled
+                logger.exception("Flushing the journal failed")
+
+    threading.Thread(target=run, daemon=True).start()
+    return stop
+
+
 def validate_task_name(task):
     """ Validate task name """
     while True:
@@ -166,6 +528,10 @@ def validate_task_duration(duration):
             print("Not a valid number of minutes.")
             duration = input("Please try again:  ")
             continue
+        if abs(duration) > MAX_INTEGER:
+            print("Duration too long.")
+            duration = input("Please try again:  ")
+            continue
         else:
             return duration
 
@@ -183,7 +549,7 @@ def validate_task_notes(notes):
 
 def fetch_tasks():
     """ Select all tasks from database """
-    entries = Entry.select().order_by(Entry.date.desc())
+    entries = Entry.with_names().order_by(Entry.date.desc())
     return entries
 
 
@@ -275,7 +641,9 @@ def search_by_employee(entries):
         employee_search = input("\nPlease enter a name of an "
                                 "employee to search by:  ")
         employee_search = validate_task_employee(employee_search)
-        entries = entries.where(Entry.employee.contains(employee_search))
+        entries = entries.where(Entry.employee_ref.in_(
+            Employee.select(Employee.id)
+            .where(Employee.name.contains(employee_search))))
         if len(entries) == 0:
             clear()
             print("Sorry. None found. Please try again")
@@ -295,16 +663,16 @@ def search_by_employee(entries):
                                            "employee:  ").strip()
                     if employee_input in employee_matches:
                         entries = \
-                            Entry.select().order_by(Entry.date.desc())\
-                            .where(Entry.employee == employee_input)
+                            Entry.with_names().order_by(Entry.date.desc())\
+                            .where(Employee.name == employee_input)
                         return entries
                     else:
                         clear()
                         print("Employee not found in list. Please try again.")
                         continue
             else:
-                entries = Entry.select().order_by(Entry.date.desc()).where(
-                    Entry.employee == employee_match)
+                entries = Entry.with_names().order_by(Entry.date.desc()).where(
+                    Employee.name == employee_match)
                 return entries
 
 
@@ -385,7 +753,8 @@ def search_by_term(entries):
         print("Search by Keyword\n")
         search_term = input("Enter a search term: ")
         entries = entries.where(
-            Entry.task.contains(search_term) or
+            Entry.task_ref.in_(Task.select(Task.id)
+                               .where(Task.name.contains(search_term))) or
             Entry.notes.contains(search_term)
         )
         if len(entries) == 0:
@@ -433,27 +802,27 @@ def edit_task(index, entries):
             task = input("Please enter a new task name:  ")
             task = validate_task_name(task)
             entry.task = task
-            entry.save()
+            save_entry(entry)
         elif edit_choice.lower() == 'b':
             date = input("Please enter a new date in the DD-MM-YYYY format:  ")
             date = validate_task_date(date)
             entry.date = date
-            entry.save()
+            save_entry(entry)
         elif edit_choice.lower() == 'c':
             employee = input("Please enter a new employee:  ")
             employee = validate_task_employee(employee)
             entry.employee = employee
-            entry.save()
+            save_entry(entry)
         elif edit_choice.lower() == 'd':
             duration = input("Please enter a new duration (minutes):  ")
             duration = validate_task_duration(duration)
             entry.duration = duration
-            entry.save()
+            save_entry(entry)
         elif edit_choice.lower() == 'e':
             notes = input("Please enter new notes (optional):  ")
             notes = validate_task_notes(notes)
             entry.notes = notes
-            entry.save()
+            save_entry(entry)
         elif edit_choice.lower() == 'm':
             menu_loop()
         else:
@@ -476,7 +845,7 @@ def delete_task(index, entries):
 
     if confirm_delete.lower() == 'y':
         clear()
-        entry.delete_instance()
+        remove_entry(entry)
         input("Entry deleted. Press any button to return.")
         return True
     else:
@@ -505,4 +874,5 @@ search_menu = OrderedDict([
 
 if __name__ == '__main__':
     initialize()
+    start_flusher()
     menu_loop()